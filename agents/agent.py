@@ -25,27 +25,52 @@ class DDPG():
             self.action_low = task.action_low
             self.action_high = task.action_high
 
+        # Replay memory
+        self.buffer_size = 100000
+        self.batch_size = 128
+        self.memory = ReplayBuffer(self.buffer_size, self.batch_size, self.state_size, self.action_size,
+                                   dtype=np.float32)
+
         # Actor (Policy) Model
-        self.actor_local = Actor(self.state_size, self.action_size, self.action_low, self.action_high)
+        self.actor_local = Actor(self.state_size, self.action_size, self.action_low, self.action_high, inference=True)
         self.actor_target = Actor(self.state_size, self.action_size, self.action_low, self.action_high)
 
         # Critic (Value) Model
-        self.critic_local = Critic(self.state_size, self.action_size)
+        self.critic_local = Critic(self.state_size, self.action_size, self.batch_size)
         self.critic_target = Critic(self.state_size, self.action_size)
 
         # Initialize target model parameters with local model parameters
         self.critic_target.model.set_weights(self.critic_local.model.get_weights())
         self.actor_target.model.set_weights(self.actor_local.model.get_weights())
 
-        # Replay memory
-        self.buffer_size = 100000
-        self.batch_size = 128
-        self.memory = ReplayBuffer(self.buffer_size, self.batch_size)
+        # Chain the target models into a single function, the learning phase is left to its
+        # inference default
+        #     Q_targets_next = critic_target(next_state, actor_target(next_state))
+        next_states = layers.Input(shape=(self.state_size,), name='next_states')
+        actions_next = self.actor_target.model(next_states)
+        Q_targets_next = self.critic_target.model([next_states, actions_next])
+        self.get_target_q = K.function(
+            inputs=[next_states],
+            outputs=[Q_targets_next])
+
+        # Single state batch reused by act
+        self.state_batch = np.empty((1, self.state_size), dtype=np.float32)
 
         # Algorithm parameters
         self.gamma = 0.95  # discount factor
         self.tau = 1e-3  # for soft update of target parameters
 
+        # Learning steps between refreshes of the folded actor used by act
+        self.fold_interval = 10
+        self.learn_count = 0
+
+        # Soft update both target models in a single function, weights stay in the graph
+        self.soft_update_fn = K.function(
+            inputs=[],
+            outputs=[],
+            updates=self.soft_update_ops(self.critic_local.model, self.critic_target.model) +
+                    self.soft_update_ops(self.actor_local.model, self.actor_target.model))
+
         # Score
         self.score = 0.0
 
@@ -53,6 +78,7 @@ class DDPG():
         # self.noise.reset()
         state = self.task.reset()
         self.last_state = state
+        self.actor_local.fold_weights()
         self.score = 0.0
         # self.noise.sigma = max(0.001, self.noise.sigma*0.99)
         return state
@@ -76,14 +102,23 @@ class DDPG():
         self.memory.add(last_state, action, reward, next_state, done)
 
     def act(self, states):
-        """Returns actions for given state(s) as per current policy with added noise for exploration."""
+        """Returns the action for a single state as per current policy, batches are not supported.
+
+        Acts on the batch normalization folded snapshot of the local actor, which is refreshed every
+        fold_interval learning steps and on reset_episode. Call actor_local.fold_weights() after
+        setting the actor weights directly (e.g. load_weights).
+        """
         # normalize state
         if hasattr(self.memory, 'state_norm') and self.memory.state_norm is not None:
             states = self.memory.state_norm.normalize(states)
 
-        state = np.reshape(states, [-1, self.state_size])
+        if np.size(states) != self.state_size:
+            raise ValueError("act takes a single state of size {}, got shape {}".format(
+                self.state_size, np.shape(states)))
+
+        np.copyto(self.state_batch[0], np.ravel(states))
 
-        action = self.actor_local.model.predict(state)[0]
+        action = self.actor_local.act_fn([self.state_batch])[0]
         return action
 
     def learn(self, experiences):
@@ -94,39 +129,42 @@ class DDPG():
 
         # Get predicted next-state actions and Q values from target models
         #     Q_targets_next = critic_target(next_state, actor_target(next_state))
-        actions_next = self.actor_target.model.predict_on_batch(next_states)
-        Q_targets_next = self.critic_target.model.predict_on_batch([next_states, actions_next])
+        Q_targets_next = self.get_target_q([next_states])[0]
 
         # Compute Q targets for current states and train critic model (local)
         Q_targets = rewards + self.gamma * Q_targets_next * (1 - dones)
 
         # Train critic model (local)
-        self.critic_local.model.train_on_batch(x=[states, actions], y=Q_targets)
+        self.critic_local.train_fn([states, actions, Q_targets, 1])
 
         # Train actor model (local)
-        action_gradients = np.reshape(self.critic_local.get_action_gradients([states, actions, 0]),
+        action_gradients = np.reshape(self.critic_local.get_action_gradients_eval([states, actions]),
                                       (-1, self.action_size))
         self.actor_local.train_fn([states, action_gradients, 1])  # custom training function
 
         # Soft-update target models
-        self.soft_update(self.critic_local.model, self.critic_target.model)
-        self.soft_update(self.actor_local.model, self.actor_target.model)
+        self.soft_update_fn([])
 
-    def soft_update(self, local_model, target_model):
-        """Soft update model parameters."""
-        local_weights = np.array(local_model.get_weights())
-        target_weights = np.array(target_model.get_weights())
+        # Refresh the folded actor used by act
+        self.learn_count += 1
+        if self.learn_count % self.fold_interval == 0:
+            self.actor_local.fold_weights()
+
+    def soft_update_ops(self, local_model, target_model):
+        """Build the soft update ops of the model parameters, run them through soft_update_fn."""
+        local_weights = local_model.weights
+        target_weights = target_model.weights
 
         assert len(local_weights) == len(target_weights), "Local and target model parameters must have the same size"
 
-        new_weights = self.tau * local_weights + (1 - self.tau) * target_weights
-        target_model.set_weights(new_weights)
+        return [K.update(target_w, self.tau * local_w + (1 - self.tau) * target_w)
+                for local_w, target_w in zip(local_weights, target_weights)]
 
 
 class Actor:
     """Actor (Policy) Model."""
 
-    def __init__(self, state_size, action_size, action_low, action_high):
+    def __init__(self, state_size, action_size, action_low, action_high, inference=False):
         """Initialize parameters and build model.
 
         Params
@@ -135,6 +173,7 @@ class Actor:
             action_size (int): Dimension of each action
             action_low (array): Min value of each action dimension
             action_high (array): Max value of each action dimension
+            inference (bool): Also build the batch normalization free copy and act_fn for acting
         """
         self.state_size = state_size
         self.action_size = action_size
@@ -145,6 +184,8 @@ class Actor:
         # Initialize any other variables here
 
         self.build_model()
+        if inference:
+            self.build_inference_model()
 
     def build_model(self):
         kernel_l2_reg = 1e-5
@@ -222,20 +263,61 @@ class Actor:
             outputs=[],
             updates=updates_op)
 
+    def build_inference_model(self):
+        """Build a copy of the model with each BatchNormalization folded into the Dense layer before it.
+
+        The copy is only valid for inference on a single state, its weights are refreshed with fold_weights().
+        """
+        states = layers.Input(batch_shape=(1, self.state_size), name='states')
+        net = states
+        for layer in self.model.layers:
+            if isinstance(layer, layers.Dense):
+                net = layers.Dense(units=layer.units, activation=layer.activation)(net)
+            elif isinstance(layer, layers.LeakyReLU):
+                net = layers.LeakyReLU(layer.alpha)(net)
+
+        self.inference_model = models.Model(inputs=states, outputs=net)
+        self.fold_weights()
+
+        # Define a function for acting on a single state, skips the batching done by model.predict
+        self.act_fn = K.function(
+            inputs=[self.inference_model.input],
+            outputs=[self.inference_model.output[0]])
+
+    def fold_weights(self):
+        """Copy the model weights into the inference model, folding in the batch normalization statistics."""
+        # Fetch all layer weights in a single call
+        values = iter(K.batch_get_value([w for layer in self.model.layers for w in layer.weights]))
+
+        weights = []
+        for layer in self.model.layers:
+            layer_weights = [next(values) for _ in layer.weights]
+            if isinstance(layer, layers.Dense):
+                weights += layer_weights
+            elif isinstance(layer, layers.BatchNormalization):
+                gamma, beta, moving_mean, moving_variance = layer_weights
+                scale = gamma / np.sqrt(moving_variance + layer.epsilon)
+                weights[-2] = weights[-2] * scale
+                weights[-1] = (weights[-1] - moving_mean) * scale + beta
+
+        self.inference_model.set_weights(weights)
+
 
 class Critic:
     """Critic (Value) Model."""
 
-    def __init__(self, state_size, action_size):
+    def __init__(self, state_size, action_size, batch_size=None):
         """Initialize parameters and build model.
 
         Params
         ======
             state_size (int): Dimension of each state
             action_size (int): Dimension of each action
+            batch_size (int): Fixed batch size of the model inputs, any size if None
         """
         self.state_size = state_size
         self.action_size = action_size
+        self.batch_size = batch_size
 
         # Initialize any other variables here
 
@@ -256,8 +338,8 @@ class Critic:
 
         """Build a critic (value) network that maps (state, action) pairs -> Q-values."""
         # Define input layers
-        states = layers.Input(shape=(self.state_size,), name='states')
-        actions = layers.Input(shape=(self.action_size,), name='actions')
+        states = layers.Input(batch_shape=(self.batch_size, self.state_size), name='states')
+        actions = layers.Input(batch_shape=(self.batch_size, self.action_size), name='actions')
 
         # size_repeat = 30
         # state_size = size_repeat*self.state_size
@@ -321,17 +403,26 @@ class Critic:
         # Create Keras model
         self.model = models.Model(inputs=[states, actions], outputs=Q_values)
 
-        # Define optimizer and compile model for training with built-in loss function
+        # Define mean squared error loss against the Q targets, plus the regularization losses
+        Q_targets = layers.Input(batch_shape=(self.batch_size, 1))
+        loss = K.mean(K.square(Q_values - Q_targets)) + sum(self.model.losses)
+
+        # Define optimizer and training function, includes the batch normalization updates
         optimizer = optimizers.Adam(lr=1e-2)
 
-        self.model.compile(optimizer=optimizer, loss='mse')
+        updates_op = optimizer.get_updates(params=self.model.trainable_weights, loss=loss)
+        self.train_fn = K.function(
+            inputs=[*self.model.input, Q_targets, K.learning_phase()],
+            outputs=[],
+            updates=updates_op + self.model.updates)
 
         # Compute action gradients (derivative of Q values w.r.t. to actions)
         action_gradients = K.gradients(Q_values, actions)
 
-        # Define an additional function to fetch action gradients (to be used by actor model)
-        self.get_action_gradients = K.function(
-            inputs=[*self.model.input, K.learning_phase()],
+        # Define an additional function to fetch action gradients (to be used by actor model),
+        # the learning phase is left to its inference default
+        self.get_action_gradients_eval = K.function(
+            inputs=[*self.model.input],
             outputs=action_gradients)
 
 
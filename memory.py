@@ -43,27 +43,54 @@ class ReplayBuffer:
 
 
 class RingBuffer:
-    """Fixed-size buffer to store experience tuples."""
-    def __init__(self, buffer_size, batch_size):
+    """Fixed-size buffer to store experience tuples, one preallocated array per field."""
+    def __init__(self, buffer_size, batch_size, state_size=None, action_size=None, dtype=np.float32):
         """Initialize a ReplayBuffer object.
         Params
         ======
             buffer_size: maximum size of buffer
             batch_size: size of each training batch
+            state_size: dimension of each state, storage is allocated on the first add if not given
+            action_size: dimension of each action
+            dtype: storage type of states, actions and rewards
         """
         self.buffer_size = buffer_size
-        self.memory = [None]*buffer_size
         # self.p = np.zeros(buffer_size)
         self.next_index = 0
         self.size = 0
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        self.dtype = dtype
+
+        # Field storage and the batch arrays reused by sample()
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.dones = None
+        self.batch = None
+        if state_size is not None and action_size is not None:
+            self.allocate(state_size, action_size)
 
         # Normalizer placeholders for state, action and reward.
         self.state_norm = None
         # self.action_norm = None
         # self.reward_norm = None
 
+    def allocate(self, state_size, action_size):
+        """Allocate the field arrays and the matching batch arrays."""
+        self.states = np.empty((self.buffer_size, state_size), dtype=self.dtype)
+        self.actions = np.empty((self.buffer_size, action_size), dtype=self.dtype)
+        self.rewards = np.empty((self.buffer_size, 1), dtype=self.dtype)
+        self.next_states = np.empty_like(self.states)
+        self.dones = np.empty((self.buffer_size, 1), dtype=np.uint8)
+
+        self.batch = tuple(np.empty((self.batch_size,) + field.shape[1:], dtype=field.dtype)
+                           for field in self.fields())
+
+    def fields(self):
+        """Return the field arrays in experience order."""
+        return self.states, self.actions, self.rewards, self.next_states, self.dones
+
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
         if np.all([state, action, reward, next_state, done] is not None):
@@ -84,9 +111,16 @@ class RingBuffer:
             # self.reward_norm.update(reward)
             # self.state_norm.update(next_state)
 
-            # Build experience and add to ring buffer
-            e = self.experience(state, action, reward, next_state, done)
-            self.memory[self.next_index] = e
+            if self.states is None:
+                self.allocate(np.size(state), np.size(action))
+
+            # Write experience into the ring buffer, converting to the storage type
+            i = self.next_index
+            self.states[i] = np.ravel(state)
+            self.actions[i] = np.ravel(action)
+            self.rewards[i] = reward
+            self.next_states[i] = np.ravel(next_state)
+            self.dones[i] = done
 
             # Increment counts
             self.next_index = self.next_index + 1
@@ -95,15 +129,17 @@ class RingBuffer:
                 self.next_index = 0
 
     def sample(self, normalize=True):
-        # Randomly sample a batch from memory
-        batch = random.sample(self.memory[:self.size], self.batch_size)
+        """Randomly sample a batch of experiences from memory.
 
-        # Structure data for learning
-        states = np.vstack([e.state for e in batch])
-        actions = np.array([e.action for e in batch]).astype(np.float32).reshape(self.batch_size, -1)
-        rewards = np.array([e.reward for e in batch]).astype(np.float32).reshape(-1, 1)
-        next_states = np.vstack([e.next_state for e in batch])
-        dones = np.array([e.done for e in batch]).astype(np.uint8).reshape(-1, 1)
+        The returned arrays are reused, they are overwritten by the next call.
+        """
+        idx = np.random.randint(0, self.size, self.batch_size)
+
+        # Gather batch rows from each field, indices are always in range so clip mode
+        # lets take write straight into the batch arrays
+        for field, out in zip(self.fields(), self.batch):
+            np.take(field, idx, axis=0, out=out, mode='clip')
+        states, actions, rewards, next_states, dones = self.batch
 
         # Normalize if possible
         # if normalize and self.state_norm is not None:
@@ -10,17 +10,21 @@ def S(x):
     return np.sin(x)
 
 
-def earth_to_body_frame(ii, jj, kk):
+def earth_to_body_frame(angles, out=None):
     # C^b_n
-    R = [[C(kk) * C(jj), C(kk) * S(jj) * S(ii) - S(kk) * C(ii), C(kk) * S(jj) * C(ii) + S(kk) * S(ii)],
-         [S(kk) * C(jj), S(kk) * S(jj) * S(ii) + C(kk) * C(ii), S(kk) * S(jj) * C(ii) - C(kk) * S(ii)],
-         [-S(jj), C(jj) * S(ii), C(jj) * C(ii)]]
-    return np.array(R)
+    ci, si = C(angles[0]), S(angles[0])
+    cj, sj = C(angles[1]), S(angles[1])
+    ck, sk = C(angles[2]), S(angles[2])
+    R = np.empty((3, 3)) if out is None else out
+    R[0, 0], R[0, 1], R[0, 2] = ck * cj, ck * sj * si - sk * ci, ck * sj * ci + sk * si
+    R[1, 0], R[1, 1], R[1, 2] = sk * cj, sk * sj * si + ck * ci, sk * sj * ci - ck * si
+    R[2, 0], R[2, 1], R[2, 2] = -sj, cj * si, cj * ci
+    return R
 
 
-def body_to_earth_frame(ii, jj, kk):
+def body_to_earth_frame(angles):
     # C^n_b
-    return np.transpose(earth_to_body_frame(ii, jj, kk))
+    return np.transpose(earth_to_body_frame(angles))
 
 
 class PhysicsSim():
@@ -47,12 +51,28 @@ class PhysicsSim():
         I_z = 1 / 12. * self.mass * (width**2 + length**2)
         self.moments_of_inertia = np.array([I_x, I_y, I_z])  # moments of inertia
 
+        # Drag coefficients, scaled by velocity squared (and by dims squared for rotation)
+        self._k_lin_drag = 0.5 * self.rho * self.C_d * self.areas
+        self._k_ang_drag = 0.5 * self.rho * self.C_d * self.areas * self.dims * self.dims
+
+        # Constant gravity force and the reused thrust force vector (only z is ever set)
+        self._gravity_force = np.array([0.0, 0.0, self.mass * self.gravity])
+        self._thrust_body_force = np.zeros(3)
+
+        # Lever arm of each rotor for the (phi_dot, theta_dot) angular velocities
+        self._rotor_mix = self.l_to_rotor * np.array([[1, -1], [-1, -1], [-1, 1], [1, 1]])
+
         env_bounds = 300.0  # 300 m / 300 m / 300 m
         self.lower_bounds = np.array([-env_bounds / 2, -env_bounds / 2, 0])
         self.upper_bounds = np.array([env_bounds / 2, env_bounds / 2, env_bounds])
 
         self.init_rotor_speeds = np.mean([self.upper_bounds, self.lower_bounds], axis=1)
 
+        # Rotation matrices for the current attitude, refreshed once per timestep.
+        # The body to earth matrix is a transposed view, so it follows _R_eb in place.
+        self._R_eb = np.empty((3, 3))
+        self._R_be = self._R_eb.T
+
         # Set initial state variables
         self.reset()
 
@@ -65,34 +85,32 @@ class PhysicsSim():
         self.linear_accel = np.zeros(3)
         self.angular_accels = np.zeros(3)
         self.prop_wind_speed = np.zeros(4)
+        self.calc_rotation_matrix()
         self.calc_prop_wind_speed()
         self.done = False
 
+    def calc_rotation_matrix(self):
+        earth_to_body_frame(self.pose[3:], out=self._R_eb)
+
     def find_body_velocity(self):
-        body_velocity = np.matmul(earth_to_body_frame(*list(self.pose[3:])), self.v)
+        body_velocity = np.dot(self._R_eb, self.v)
         return body_velocity
 
     def get_linear_drag(self):
         body_velocity = self.find_body_velocity()
 
-        # Drag magnitude
-        linear_drag = 0.5 * self.rho * body_velocity**2 * self.areas * self.C_d
-
-        # Direction of drag
-        linear_drag = -np.sign(body_velocity) * linear_drag
-        return linear_drag
+        # Drag magnitude opposing the direction of travel
+        return -np.sign(body_velocity) * self._k_lin_drag * body_velocity * body_velocity
 
     def get_linear_forces(self, thrusts):
-        # Gravity
-        gravity_force = self.mass * self.gravity * np.array([0, 0, 1])
         # Thrust
-        thrust_body_force = np.array([0, 0, sum(thrusts)])
+        self._thrust_body_force[2] = thrusts.sum()
         # Drag
         drag_body_force = self.get_linear_drag()
-        body_forces = thrust_body_force + drag_body_force
+        body_forces = self._thrust_body_force + drag_body_force
 
-        linear_forces = np.matmul(body_to_earth_frame(*list(self.pose[3:])), body_forces)
-        linear_forces += gravity_force
+        linear_forces = np.dot(self._R_be, body_forces)
+        linear_forces += self._gravity_force
         return linear_forces
 
     def get_moments(self, thrusts):
@@ -129,24 +147,15 @@ class PhysicsSim():
                                   (thrusts[2] + thrusts[3] - thrusts[0] - thrusts[1]) * self.l_to_rotor,
                                   (thrusts[0] + thrusts[2] - thrusts[1] - thrusts[3]) * self.T_q])
 
-        drag_moment = self.C_d * 0.5 * self.rho * self.angular_v * np.absolute(self.angular_v) * self.areas * self.dims * self.dims
+        drag_moment = self._k_ang_drag * self.angular_v * np.absolute(self.angular_v)
         moments = thrust_moment - drag_moment  # + motor_inertia_moment
         return moments
 
     def calc_prop_wind_speed(self):
         body_velocity = self.find_body_velocity()[2]
-        phi_dot, theta_dot = self.angular_v[0], self.angular_v[1]
 
-        # Angular velocity about x-axis
-        phi_vel = phi_dot * self.l_to_rotor
-
-        # Angular velocity about y-axis
-        theta_vel = theta_dot * self.l_to_rotor
-
-        self.prop_wind_speed[0] = body_velocity + phi_vel - theta_vel
-        self.prop_wind_speed[1] = body_velocity - phi_vel - theta_vel
-        self.prop_wind_speed[2] = body_velocity - phi_vel + theta_vel
-        self.prop_wind_speed[3] = body_velocity + phi_vel + theta_vel
+        # Rotor speed from the angular velocities about the x- and y-axis
+        self.prop_wind_speed = body_velocity + np.dot(self._rotor_mix, self.angular_v[:2])
 
         # s_0 = np.array([0., 0., theta_dot * self.l_to_rotor])
         # s_1 = -s_0
@@ -160,23 +169,22 @@ class PhysicsSim():
     def get_propeller_thrust(self, rotor_speeds):
         '''calculates net thrust (thrust - drag) based on velocity
         of propeller and incoming power'''
-        thrusts = []
-        for prop_number in range(4):
-            V = self.prop_wind_speed[prop_number]
-            D = self.propeller_size
-            n = rotor_speeds[prop_number]
-            if abs(n) > 1:
-                J = V / (n * D)
-            else:
-                J = 0.0
-            # From http://m-selig.ae.illinois.edu/pubs/BrandtSelig-2011-AIAA-2011-1255-LRN-Propellers.pdf
-            # C_T = max(0.12 - 0.07*max(0.0, J)-.1*max(0.0, J)**2, 0.0)
-            C_T = 0.12 - 0.07 * J - 0.1 * J**2
-            thrusts.append(C_T * self.rho * n**2 * D**4)
-        return thrusts
+        V = self.prop_wind_speed
+        D = self.propeller_size
+        n = np.asarray(rotor_speeds, dtype=float)
+
+        # Advance ratio, zero for (nearly) stopped rotors
+        J = np.zeros_like(n)
+        np.divide(V, n * D, out=J, where=np.absolute(n) > 1)
+
+        # From http://m-selig.ae.illinois.edu/pubs/BrandtSelig-2011-AIAA-2011-1255-LRN-Propellers.pdf
+        # C_T = max(0.12 - 0.07*max(0.0, J)-.1*max(0.0, J)**2, 0.0)
+        C_T = 0.12 - 0.07 * J - 0.1 * J * J
+        return C_T * self.rho * n * n * D**4
 
     def next_timestep(self, rotor_speeds):
         self.rotor_speeds = rotor_speeds
+        self.calc_rotation_matrix()
         self.calc_prop_wind_speed()
         thrusts = self.get_propeller_thrust(rotor_speeds)
         self.linear_accel = self.get_linear_forces(thrusts) / self.mass
@@ -191,19 +199,114 @@ class PhysicsSim():
         angles = (angles + 2 * np.pi) % (2 * np.pi)
         self.angular_v = self.angular_v + self.angular_accels * self.dt
 
-        new_positions = []
-        for ii in range(3):
-            if position[ii] <= self.lower_bounds[ii]:
-                new_positions.append(self.lower_bounds[ii])
-                self.done = True
-            elif position[ii] > self.upper_bounds[ii]:
-                new_positions.append(self.upper_bounds[ii])
-                self.done = True
-            else:
-                new_positions.append(position[ii])
-
-        self.pose = np.array(new_positions + list(angles))
+        # Clamp to the environment bounds, hitting a wall ends the episode
+        if np.any((position <= self.lower_bounds) | (position > self.upper_bounds)):
+            self.done = True
+        position = np.clip(position, self.lower_bounds, self.upper_bounds)
+
+        self.pose = np.concatenate((position, angles))
         self.time += self.dt
         if self.time > self.runtime:
             self.done = True
-        return self.done
\ No newline at end of file
+        return self.done
+
+
+class VecPhysicsSim(PhysicsSim):
+    """Steps num_envs independent quadcopters together.
+
+    State arrays carry a leading environment axis, pose is (num_envs, 6), v is (num_envs, 3), time is
+    (num_envs,), etc. next_timestep takes (num_envs, 4) rotor speeds and returns a (num_envs,) done mask.
+    Finished environments keep integrating, reset them with reset(sim.done) before the next step.
+    """
+    def __init__(self, num_envs, init_pose=None, init_velocities=None, init_angle_vel=None, runtime=5.):
+        self.num_envs = num_envs
+        super().__init__(init_pose, init_velocities, init_angle_vel, runtime)
+
+    def tile(self, x):
+        # Broadcast a per-environment value, or pass through one given for every environment
+        return np.array(np.broadcast_to(x, (self.num_envs,) + np.shape(x)[-1:]), dtype=float)
+
+    def reset(self, mask=None):
+        """Reset every environment, or only those selected by the boolean mask."""
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+            self.time = np.zeros(self.num_envs)
+            self.rotor_speeds = self.tile(self.init_rotor_speeds)
+            self.pose = np.empty((self.num_envs, 6))
+            self.v = np.empty((self.num_envs, 3))
+            self.angular_v = np.empty((self.num_envs, 3))
+            self.linear_accel = np.empty((self.num_envs, 3))
+            self.angular_accels = np.empty((self.num_envs, 3))
+            self.prop_wind_speed = np.zeros((self.num_envs, 4))
+            self.done = np.empty(self.num_envs, dtype=bool)
+
+            # Rotation matrices stored environment last, so earth_to_body_frame fills them all at once
+            self._R_eb = np.empty((3, 3, self.num_envs))
+            self._R_be = self._R_eb.transpose(1, 0, 2)
+            self._thrust_body_force = np.zeros((self.num_envs, 3))
+
+        # Rotor speeds are left as is, they are replaced on the next step
+        self.time[mask] = 0.0
+        self.pose[mask] = self.tile(self.init_pose)[mask]
+        self.v[mask] = self.tile(self.init_velocities)[mask]
+        self.angular_v[mask] = self.tile(self.init_angle_velocities)[mask]
+        self.linear_accel[mask] = 0.0
+        self.angular_accels[mask] = 0.0
+        self.done[mask] = False
+
+        self.calc_rotation_matrix()
+        self.calc_prop_wind_speed()
+
+    def calc_rotation_matrix(self):
+        earth_to_body_frame(self.pose[:, 3:].T, out=self._R_eb)
+
+    def find_body_velocity(self):
+        return np.einsum('ije,ej->ei', self._R_eb, self.v)
+
+    def get_linear_forces(self, thrusts):
+        self._thrust_body_force[:, 2] = thrusts.sum(axis=1)
+        body_forces = self._thrust_body_force + self.get_linear_drag()
+
+        linear_forces = np.einsum('ije,ej->ei', self._R_be, body_forces)
+        linear_forces += self._gravity_force
+        return linear_forces
+
+    def get_moments(self, thrusts):
+        # Same thrust differences as PhysicsSim.get_moments, so equal thrusts give exactly zero moment
+        t0, t1, t2, t3 = thrusts.T
+        thrust_moment = np.stack(((t0 + t3 - t1 - t2) * self.l_to_rotor,
+                                  (t2 + t3 - t0 - t1) * self.l_to_rotor,
+                                  (t0 + t2 - t1 - t3) * self.T_q), axis=1)
+
+        drag_moment = self._k_ang_drag * self.angular_v * np.absolute(self.angular_v)
+        return thrust_moment - drag_moment
+
+    def calc_prop_wind_speed(self):
+        body_velocity = self.find_body_velocity()[:, 2:]
+        self.prop_wind_speed = body_velocity + np.dot(self.angular_v[:, :2], self._rotor_mix.T)
+
+    def next_timestep(self, rotor_speeds):
+        self.rotor_speeds = rotor_speeds
+        self.calc_rotation_matrix()
+        self.calc_prop_wind_speed()
+        thrusts = self.get_propeller_thrust(rotor_speeds)
+        self.linear_accel = self.get_linear_forces(thrusts) / self.mass
+
+        position = self.pose[:, :3] + self.v * self.dt + 0.5 * self.linear_accel * self.dt*self.dt
+        self.v += self.linear_accel * self.dt
+
+        moments = self.get_moments(thrusts)
+
+        self.angular_accels = moments / self.moments_of_inertia
+        angles = self.pose[:, 3:] + self.angular_v * self.dt + 0.5 * self.angular_accels * self.dt*self.dt
+        angles = (angles + 2 * np.pi) % (2 * np.pi)
+        self.angular_v = self.angular_v + self.angular_accels * self.dt
+
+        # Clamp to the environment bounds, hitting a wall ends that environment's episode
+        self.done |= np.any((position <= self.lower_bounds) | (position > self.upper_bounds), axis=1)
+        position = np.clip(position, self.lower_bounds, self.upper_bounds)
+
+        self.pose = np.concatenate((position, angles), axis=1)
+        self.time += self.dt
+        self.done |= self.time > self.runtime
+        return self.done
@@ -0,0 +1,85 @@
+import numpy as np
+
+from memory import RingBuffer
+
+
+def experience(i, state_size=3, action_size=2):
+    state = np.arange(state_size) + 10.0 * i
+    action = np.full(action_size, i + 0.5)
+    return state, action, float(i), state + 1000.0, i % 2
+
+
+def fill(memory, count):
+    for i in range(count):
+        memory.add(*experience(i))
+
+
+def test_field_shapes_and_dtypes():
+    memory = RingBuffer(8, 4, state_size=3, action_size=2)
+    assert memory.states.shape == (8, 3) and memory.next_states.shape == (8, 3)
+    assert memory.actions.shape == (8, 2)
+    assert memory.rewards.shape == (8, 1) and memory.dones.shape == (8, 1)
+    for field in (memory.states, memory.actions, memory.rewards, memory.next_states):
+        assert field.dtype == np.float32
+    assert memory.dones.dtype == np.uint8
+
+    fill(memory, 5)
+    states, actions, rewards, next_states, dones = memory.sample()
+    assert states.shape == (4, 3) and next_states.shape == (4, 3)
+    assert actions.shape == (4, 2)
+    assert rewards.shape == (4, 1) and dones.shape == (4, 1)
+    assert states.dtype == np.float32 and dones.dtype == np.uint8
+
+
+def test_lazy_allocation():
+    memory = RingBuffer(8, 4)
+    assert memory.states is None and memory.batch is None
+    assert len(memory) == 0
+
+    memory.add(*experience(0, state_size=6, action_size=4))
+    assert memory.states.shape == (8, 6)
+    assert memory.actions.shape == (8, 4)
+    assert len(memory) == 1
+    np.testing.assert_array_equal(memory.states[0], experience(0, 6, 4)[0])
+
+
+def test_ring_wraparound():
+    memory = RingBuffer(5, 4, state_size=3, action_size=2)
+    fill(memory, 7)
+    assert len(memory) == 5
+    assert memory.next_index == 2
+
+    # The two newest experiences overwrite the two oldest rows
+    for row, i in enumerate([5, 6, 2, 3, 4]):
+        state, action, reward, next_state, done = experience(i)
+        np.testing.assert_array_equal(memory.states[row], state)
+        np.testing.assert_array_equal(memory.actions[row], action)
+        assert memory.rewards[row, 0] == reward
+        np.testing.assert_array_equal(memory.next_states[row], next_state)
+        assert memory.dones[row, 0] == done
+
+
+def test_sample_rows_stay_aligned():
+    np.random.seed(0)
+    memory = RingBuffer(16, 32, state_size=3, action_size=2)
+    fill(memory, 20)
+    states, actions, rewards, next_states, dones = memory.sample()
+    i = rewards[:, 0].astype(int)
+    assert (i >= 4).all()  # only experiences still in the buffer
+    np.testing.assert_array_equal(states[:, 0], 10.0 * i)
+    np.testing.assert_array_equal(actions[:, 0], i + 0.5)
+    np.testing.assert_array_equal(next_states, states + 1000.0)
+    np.testing.assert_array_equal(dones[:, 0], i % 2)
+
+
+def test_second_sample_overwrites_first():
+    np.random.seed(0)
+    memory = RingBuffer(64, 16, state_size=3, action_size=2)
+    fill(memory, 64)
+    first = memory.sample()
+    first_states = first[0].copy()
+    second = memory.sample()
+
+    for a, b in zip(first, second):
+        assert a is b
+    assert not np.array_equal(first[0], first_states)
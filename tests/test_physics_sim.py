@@ -0,0 +1,112 @@
+import numpy as np
+
+from physics_sim import PhysicsSim, VecPhysicsSim
+
+STATE = ['pose', 'v', 'angular_v', 'linear_accel', 'angular_accels', 'prop_wind_speed']
+
+
+def make_sims(num_envs, seed=0):
+    rng = np.random.RandomState(seed)
+    poses = np.column_stack((rng.uniform(-5, 5, (num_envs, 2)), rng.uniform(5, 20, num_envs),
+                             rng.uniform(0, 0.5, (num_envs, 3))))
+    poses[-1, 2] = 0.3  # close to the ground, hits the lower bound
+    velocities = rng.randn(num_envs, 3)
+    angle_velocities = 0.2 * rng.randn(num_envs, 3)
+
+    vec = VecPhysicsSim(num_envs, poses.copy(), velocities.copy(), angle_velocities.copy(), runtime=3.)
+    sims = [PhysicsSim(poses[e].copy(), velocities[e].copy(), angle_velocities[e].copy(), runtime=3.)
+            for e in range(num_envs)]
+    return vec, sims
+
+
+def assert_lanes_match(vec, sims, lanes):
+    for e in lanes:
+        for name in STATE:
+            np.testing.assert_allclose(getattr(vec, name)[e], getattr(sims[e], name), rtol=1e-9, atol=1e-9)
+        assert vec.done[e] == sims[e].done
+        assert vec.time[e] == sims[e].time
+
+
+
+# Reference values from the original, unoptimized PhysicsSim
+def test_sim_matches_reference_trajectory():
+    sim = PhysicsSim(np.array([1.0, -2.0, 10.0, 0.1, 0.2, 0.3]), np.array([0.5, -0.3, 1.0]),
+                     np.array([0.1, -0.2, 0.05]), runtime=5.)
+    for step in range(50):
+        sim.next_timestep(np.array([400.0, 410.0, 395.0, 405.0]) + 5 * np.sin(step))
+
+    # theta went negative and is wrapped back into [0, 2*pi)
+    np.testing.assert_allclose(sim.pose, [1.3654762764467352, -1.7123317737992736, 10.783132284337746,
+                                          0.1588220908859368, 5.6976216745335115, 0.07343186395667622],
+                               rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sim.v, [1.4649803917130961, 0.9352039937767657, 0.3731450436623343],
+                               rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sim.angular_v, [0.03014529081338673, -1.1687931140040648, -0.5002443533407552],
+                               rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sim.linear_accel, [4.927615053377776, 1.2197356506532027, -2.056171380118788],
+                               rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sim.angular_accels, [-0.0392356904544136, -0.4344613387281127, -0.5320379876432404],
+                               rtol=1e-12, atol=1e-12)
+    assert not sim.done
+
+
+def test_sim_hover_reference():
+    sim = PhysicsSim()
+    for _ in range(10):
+        sim.next_timestep(400 * np.ones(4))
+    np.testing.assert_allclose(sim.pose[:3], [0.0, 0.0, 9.99623122464016], rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sim.v, [0.0, 0.0, -0.037511998726459016], rtol=1e-12, atol=1e-12)
+    # Level attitude stays at 0, it must not wrap to 2*pi
+    np.testing.assert_array_equal(sim.pose[3:], 0.0)
+
+
+def test_sim_ground_hit_reference():
+    sim = PhysicsSim(np.array([0.0, 0.0, 0.5, 0.0, 0.0, 0.0]))
+    done = [sim.next_timestep(np.zeros(4)) for _ in range(20)]
+    assert done.index(True) == 16
+    np.testing.assert_array_equal(sim.pose, 0.0)
+
+def test_vec_matches_independent_sims():
+    num_envs = 5
+    vec, sims = make_sims(num_envs)
+    rng = np.random.RandomState(1)
+    for step in range(160):
+        rotor_speeds = rng.uniform(380, 450, (num_envs, 4))
+        rotor_speeds[-1] = rng.uniform(50, 100, 4)
+        if step == 3:
+            rotor_speeds[2, 1] = 0.5  # stalled rotor
+        vec.next_timestep(rotor_speeds.copy())
+        for e, sim in enumerate(sims):
+            sim.next_timestep(rotor_speeds[e].copy())
+        assert_lanes_match(vec, sims, range(num_envs))
+    assert vec.done.all()
+
+
+def test_vec_hover_matches_sim():
+    vec = VecPhysicsSim(3)
+    sim = PhysicsSim()
+    vec.next_timestep(400 * np.ones((3, 4)))
+    sim.next_timestep(400 * np.ones(4))
+    for e in range(3):
+        np.testing.assert_array_equal(vec.pose[e], sim.pose)
+    assert (vec.pose[:, 3:] < 2 * np.pi).all()
+
+
+def test_vec_reset_mask():
+    num_envs = 4
+    vec, sims = make_sims(num_envs)
+    for _ in range(20):
+        vec.next_timestep(420 * np.ones((num_envs, 4)))
+        for sim in sims:
+            sim.next_timestep(420 * np.ones(4))
+
+    mask = np.array([True, False, True, False])
+    vec.reset(mask)
+    for e in np.flatnonzero(mask):
+        sims[e].reset()
+
+    for _ in range(5):
+        vec.next_timestep(410 * np.ones((num_envs, 4)))
+        for sim in sims:
+            sim.next_timestep(410 * np.ones(4))
+    assert_lanes_match(vec, sims, range(num_envs))